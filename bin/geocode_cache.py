@@ -0,0 +1,511 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Persistent geocode result caches shared by every search that runs the geocoding command.
+
+Results are keyed by normalized address (see :mod:`geocode_normalize`) and each entry holds the parsed output fields
+of one address as JSON. Entries expire after a TTL. Addresses the API cannot resolve are cached too, with a separate
+and usually shorter TTL, so that garbage input does not spend quota in every search. Two stores are available:
+
+* :class:`GeocodeCache` keeps results in a SQLite file under the app directory of one server and evicts the least
+  recently used entries once it grows past its size cap.
+* :class:`KVStoreCache` keeps results in a KV Store collection, which a search head cluster replicates to all of its
+  members, behind a bounded in-process LRU. Lookups and writes are sent in batches.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("geocoding")
+
+KVSTORE_COLLECTION = "geocode_cache"
+
+# Documents per batch_save call (max_documents_per_batch_save), queries per batch_find call (max_queries_per_batch)
+# and keys matched by each of those queries, within the default limits.conf [kvstore] settings
+KVSTORE_BATCH_SIZE = 1000
+KVSTORE_QUERIES_PER_BATCH = 1000
+KVSTORE_KEYS_PER_QUERY = 1000
+
+# Entries read per query when iterating over a whole cache
+ENTRIES_PAGE_SIZE = 1000
+
+# Keys matched by each SQLite query, below its default limit of 999 parameters per statement
+SQLITE_KEYS_PER_QUERY = 500
+
+# Share of max_size evicted beyond the excess once the SQLite cache is full, so that the table is counted and trimmed
+# once per that many insertions instead of on every one
+EVICTION_SHARE = 0.01
+
+# Final statuses of addresses the API cannot resolve, cached with the negative TTL. Transient failures are never cached.
+NEGATIVE_STATUSES = frozenset(["ZERO_RESULTS", "INVALID_REQUEST"])
+
+
+def expired(fields, age, ttl, negative_ttl):
+    """ Returns whether an entry holding `fields` that was stored `age` seconds ago has expired.
+
+    """
+    return age > (negative_ttl if fields.get("msg") in NEGATIVE_STATUSES else ttl)
+
+
+class GeocodeCache(object):
+    """ Thread-safe, size-capped LRU cache of geocode results persisted to a SQLite file.
+
+    SQLite errors of lookups and writes, such as a file locked by another search beyond the busy timeout, are logged
+    and treated as cache misses and skipped writes; the cache only ever saves work.
+
+    :param path: Location of the SQLite file. Parent directories are created as needed.
+    :param ttl: Seconds an entry stays valid after it was stored.
+    :param negative_ttl: Seconds an entry with one of the :const:`NEGATIVE_STATUSES` stays valid.
+    :param max_size: Maximum number of entries kept. The least recently used entries are evicted beyond that.
+
+    """
+    def __init__(self, path, ttl, max_size, negative_ttl=0):
+        directory = os.path.dirname(path)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            "key TEXT PRIMARY KEY, "
+            "value TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "accessed REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS geocode_accessed ON geocode (accessed)")
+
+        # Number of entries, kept up to date by this instance and re-read before evicting since other searches share
+        # the file
+        self._count = self._connection.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def get(self, key, stale=False):
+        """ Returns the cached fields for `key` and whether they are fresh, or :const:`None` if there is no entry.
+
+        Expired entries are deleted unless `stale` is set, in which case they are returned as not fresh.
+
+        """
+        return self.get_many([key], stale).get(key)
+
+    def get_many(self, keys, stale=False):
+        """ Returns a dict of (fields, fresh) pairs for those `keys` that have a valid entry, or any entry if `stale`.
+
+        Keys are read with one query per :const:`SQLITE_KEYS_PER_QUERY` keys. The access times of the entries found are
+        updated, and expired entries deleted, in a single transaction.
+
+        """
+        now = time.time()
+        keys = list(keys)
+        found = {}
+        expired_keys = []
+
+        with self._lock:
+            try:
+                for start in range(0, len(keys), SQLITE_KEYS_PER_QUERY):
+                    batch = keys[start:start + SQLITE_KEYS_PER_QUERY]
+                    rows = self._connection.execute(
+                        "SELECT key, value, created FROM geocode WHERE key IN ({})".format(",".join("?" * len(batch))),
+                        batch)
+
+                    for key, value, created in rows:
+                        fields = json.loads(value)
+                        fresh = not expired(fields, now - created, self.ttl, self.negative_ttl)
+
+                        if fresh or stale:
+                            found[key] = fields, fresh
+                        else:
+                            expired_keys.append((key,))
+            except sqlite3.Error as e:
+                logger.warning("SQLite cache lookup of %d keys failed: %s", len(keys), e)
+                return {}
+
+            # Entries are returned even if their access times cannot be updated
+            try:
+                if found or expired_keys:
+                    with self._transaction() as connection:
+                        connection.executemany(
+                            "UPDATE geocode SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+
+                        # executemany reports a rowcount of -1 for an empty list of parameters
+                        if expired_keys:
+                            deleted = connection.executemany(
+                                "DELETE FROM geocode WHERE key = ?", expired_keys).rowcount
+                        else:
+                            deleted = 0
+
+                    self._count -= deleted
+            except sqlite3.Error as e:
+                logger.warning("SQLite cache update of %d keys failed: %s", len(found) + len(expired_keys), e)
+
+        return found
+
+    def set(self, key, fields):
+        """ Stores `fields` under `key` and evicts the least recently used entries beyond `max_size`.
+
+        """
+        now = time.time()
+        value = json.dumps(fields, separators=(",", ":"))
+
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    updated = connection.execute(
+                        "UPDATE geocode SET value = ?, created = ?, accessed = ? WHERE key = ?", (value, now, now, key))
+
+                    count = self._count
+
+                    if updated.rowcount == 0:
+                        connection.execute(
+                            "INSERT INTO geocode (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                            (key, value, now, now))
+                        count += 1
+
+                    if count > self.max_size:
+                        count = self._evict()
+
+                # Counted once committed, as a failed commit rolls the insertion back
+                self._count = count
+            except sqlite3.Error as e:
+                logger.warning("SQLite cache write failed: %s", e)
+
+    def entries(self):
+        """ Yields every entry as a (key, created, value) tuple in key order, where value is the JSON of its fields.
+
+        """
+        last = ""
+
+        while True:
+            with self._lock:
+                try:
+                    rows = self._connection.execute(
+                        "SELECT key, created, value FROM geocode WHERE key > ? ORDER BY key LIMIT ?",
+                        (last, ENTRIES_PAGE_SIZE)).fetchall()
+                except sqlite3.Error as e:
+                    raise RuntimeError("SQLite cache read of {} failed: {}".format(self.path, e))
+
+            for row in rows:
+                yield row
+
+            if len(rows) < ENTRIES_PAGE_SIZE:
+                return
+
+            last = rows[-1][0]
+
+    def load(self, entries):
+        """ Stores (key, created, value) tuples as produced by :meth:`entries`, replacing existing entries.
+
+        Entries are written in batches of one transaction each and expired entries are skipped. Unlike lookups, failed
+        writes raise :class:`RuntimeError`.
+
+        :return: Number of entries stored and number skipped.
+
+        """
+        now = time.time()
+        loaded = skipped = 0
+        batch = []
+
+        def write(batch):
+            try:
+                with self._lock, self._transaction() as connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO geocode (key, value, created, accessed) VALUES (?, ?, ?, ?)", batch)
+            except sqlite3.Error as e:
+                raise RuntimeError("SQLite cache write of {} entries failed: {}".format(len(batch), e))
+
+        for key, created, value in entries:
+            if expired(json.loads(value), now - created, self.ttl, self.negative_ttl):
+                skipped += 1
+                continue
+
+            batch.append((key, value, created, created))
+
+            if len(batch) == KVSTORE_BATCH_SIZE:
+                write(batch)
+                loaded += len(batch)
+                batch = []
+
+        if batch:
+            write(batch)
+            loaded += len(batch)
+
+        try:
+            with self._lock, self._transaction():
+                self._count = self._evict()
+        except sqlite3.Error as e:
+            raise RuntimeError("SQLite cache eviction failed: {}".format(e))
+
+        return loaded, skipped
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        # Runs the statements of a with block in one transaction, rolled back if they or the commit fail; the caller
+        # holds the lock
+        self._connection.execute("BEGIN")
+
+        try:
+            yield self._connection
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+        # Counts the entries, deletes the least recently used ones beyond max_size, plus EVICTION_SHARE of it, and
+        # returns the number left
+        count = self._connection.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+        if count > self.max_size:
+            excess = count - self.max_size + int(self.max_size * EVICTION_SHARE)
+            count -= self._connection.execute(
+                "DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY accessed LIMIT ?)",
+                (excess,)).rowcount
+
+        return count
+
+
+class KVStoreCache(object):
+    """ Two-tier cache: a bounded in-process LRU in front of a KV Store collection.
+
+    Keys missing from the LRU are fetched from the collection with :meth:`get_many` in as few `batch_find` calls as
+    the server limits allow: each call carries up to :const:`KVSTORE_QUERIES_PER_BATCH` queries that each match up to
+    :const:`KVSTORE_KEYS_PER_QUERY` document keys. New entries go to the LRU at once and are written back to the collection with `batch_save` once
+    :const:`KVSTORE_BATCH_SIZE` of them are pending and when the cache is closed. Errors talking to the KV Store are
+    logged and treated as cache misses; the cache only ever saves work.
+
+    :param collection: :class:`splunklib.client.KVStoreCollectionData` of the collection.
+    :param ttl: Seconds an entry stays valid after it was stored.
+    :param negative_ttl: Seconds an entry with one of the :const:`NEGATIVE_STATUSES` stays valid.
+    :param max_size: Maximum number of entries kept in the LRU.
+
+    """
+    def __init__(self, collection, ttl, max_size, negative_ttl=0):
+        self.collection = collection
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+        self._writes = []
+
+    @staticmethod
+    def document_key(key):
+        """ Returns the `_key` of the document of `key`. Addresses are hashed to keep document keys short and safe.
+
+        """
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, created, fields):
+        self._lru[key] = (created, fields)
+
+        if len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def get_many(self, keys, stale=False):
+        """ Returns a dict of (fields, fresh) pairs for those `keys` that have a valid entry, or any entry if `stale`.
+
+        Expired entries of the LRU are looked up in the collection too, which another search may have refreshed.
+        Expired documents are deleted from the collection unless `stale` is set, in which case they are returned as
+        not fresh.
+
+        """
+        now = time.time()
+        found = {}
+        missing = {}
+        expired_documents = []
+
+        with self._lock:
+            for key in keys:
+                entry = self._lru.pop(key, None)
+
+                if entry is None:
+                    missing[self.document_key(key)] = key
+                    continue
+
+                if not expired(entry[1], now - entry[0], self.ttl, self.negative_ttl):
+                    self._lru[key] = entry
+                    found[key] = dict(entry[1]), True
+                    continue
+
+                missing[self.document_key(key)] = key
+
+                if stale:
+                    self._lru[key] = entry
+                    found[key] = dict(entry[1]), False
+
+        document_keys = list(missing)
+        keys_per_batch = KVSTORE_QUERIES_PER_BATCH * KVSTORE_KEYS_PER_QUERY
+
+        for start in range(0, len(document_keys), keys_per_batch):
+            batch = document_keys[start:start + keys_per_batch]
+            queries = [
+                {"query": {"$or": [{"_key": k} for k in batch[i:i + KVSTORE_KEYS_PER_QUERY]]}}
+                for i in range(0, len(batch), KVSTORE_KEYS_PER_QUERY)]
+
+            try:
+                results = self.collection.batch_find(*queries)
+            except Exception as e:
+                logger.warning("KV Store lookup of %d keys failed: %s", len(batch), e)
+                continue
+
+            with self._lock:
+                for document in (document for documents in results for document in documents):
+                    key = missing.get(document.get("_key"))
+
+                    if key is None:
+                        continue
+
+                    fields = json.loads(document["value"])
+                    fresh = not expired(fields, now - document["created"], self.ttl, self.negative_ttl)
+
+                    if fresh or stale and key not in found:
+                        self._remember(key, document["created"], dict(fields))
+                        found[key] = fields, fresh
+                    elif not stale:
+                        expired_documents.append({"_key": document["_key"], "created": document["created"]})
+
+        self._delete(expired_documents)
+
+        return found
+
+    def _delete(self, documents):
+        # Deletes the given documents unless another search has stored them again since they were read
+        for start in range(0, len(documents), KVSTORE_KEYS_PER_QUERY):
+            batch = documents[start:start + KVSTORE_KEYS_PER_QUERY]
+
+            try:
+                self.collection.delete(json.dumps({"$or": batch}))
+            except Exception as e:
+                logger.warning("KV Store delete of %d expired entries failed: %s", len(batch), e)
+
+    def set(self, key, fields):
+        """ Stores `fields` under `key` in the LRU and queues it for the KV Store.
+
+        """
+        now = time.time()
+        document = {
+            "_key": self.document_key(key),
+            "address": key,
+            "value": json.dumps(fields, separators=(",", ":")),
+            "created": now,
+        }
+
+        with self._lock:
+            self._remember(key, now, dict(fields))
+            self._writes.append(document)
+
+            if len(self._writes) < KVSTORE_BATCH_SIZE:
+                return
+
+            writes, self._writes = self._writes, []
+
+        self._save(writes)
+
+    def _save(self, documents):
+        try:
+            self.collection.batch_save(*documents)
+        except Exception as e:
+            logger.warning("KV Store write of %d entries failed: %s", len(documents), e)
+
+    def flush(self):
+        """ Writes the queued entries to the KV Store.
+
+        """
+        with self._lock:
+            writes, self._writes = self._writes, []
+
+        for start in range(0, len(writes), KVSTORE_BATCH_SIZE):
+            self._save(writes[start:start + KVSTORE_BATCH_SIZE])
+
+    def entries(self):
+        """ Yields every entry as a (key, created, value) tuple in key order, where value is the JSON of its fields.
+
+        """
+        query = {}
+
+        while True:
+            try:
+                documents = self.collection.query(
+                    query=json.dumps(query), sort="address", limit=ENTRIES_PAGE_SIZE, fields="address,created,value")
+            except Exception as e:
+                raise RuntimeError("KV Store read of the {} collection failed: {}".format(KVSTORE_COLLECTION, e))
+
+            for document in documents:
+                yield document["address"], document["created"], document["value"]
+
+            if len(documents) < ENTRIES_PAGE_SIZE:
+                return
+
+            query = {"address": {"$gt": documents[-1]["address"]}}
+
+    def load(self, entries):
+        """ Stores (key, created, value) tuples as produced by :meth:`entries`, replacing existing entries.
+
+        Entries are written with `batch_save` and expired entries are skipped. Unlike lookups, failed writes raise
+        :class:`RuntimeError`.
+
+        :return: Number of entries stored and number skipped.
+
+        """
+        now = time.time()
+        loaded = skipped = 0
+        batch = []
+
+        def write(batch):
+            try:
+                self.collection.batch_save(*batch)
+            except Exception as e:
+                raise RuntimeError("KV Store write of {} entries failed: {}".format(len(batch), e))
+
+        for key, created, value in entries:
+            if expired(json.loads(value), now - created, self.ttl, self.negative_ttl):
+                skipped += 1
+                continue
+
+            batch.append({"_key": self.document_key(key), "address": key, "value": value, "created": created})
+
+            if len(batch) == KVSTORE_BATCH_SIZE:
+                write(batch)
+                loaded += len(batch)
+                batch = []
+
+        if batch:
+            write(batch)
+            loaded += len(batch)
+
+        return loaded, skipped
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,137 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" HTTP transport and rate limiting shared by the workers of the geocoding command.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+# Connection failures retried by the transport adapter before a request is sent. Failures after that, such as
+# connection resets and read timeouts, are classified and retried by the command so they count as attempts.
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+
+# How the command handles the outcome of a request: DONE is final, RETRY is retried and THROTTLED is retried after
+# slowing down the rate limiter. Statuses are either API statuses of a decoded response or HTTP status codes.
+DONE, RETRY, THROTTLED = "done", "retry", "throttled"
+THROTTLE_STATUSES = frozenset(["OVER_QUERY_LIMIT", 429, 503])
+RETRY_STATUSES = frozenset(["UNKNOWN_ERROR", 500, 502, 504])
+
+BACKOFF_MAX = 30.0
+
+# Lowest rate the limiter backs off to, in requests per second
+MIN_RATE = 0.5
+
+
+def create_session(pool_size):
+    """ Returns a :class:`requests.Session` whose HTTPS connection pool holds up to `pool_size` keep-alive connections.
+
+    A session is safe to share between the worker threads: each request checks a connection out of the pool, so the
+    TCP and TLS handshakes are paid once per connection instead of once per address.
+
+    """
+    retry = Retry(total=RETRY_TOTAL, read=0, backoff_factor=RETRY_BACKOFF_FACTOR)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def classify(status):
+    """ Returns :const:`DONE`, :const:`RETRY` or :const:`THROTTLED` for a request that ended with `status`.
+
+    """
+    if status in THROTTLE_STATUSES:
+        return THROTTLED
+
+    if status in RETRY_STATUSES:
+        return RETRY
+
+    return DONE
+
+
+def backoff_delay(retry, base):
+    """ Returns the jittered number of seconds to wait before retry number `retry`, doubling `base` every retry.
+
+    """
+    delay = min(base * 2 ** (retry - 1), BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RateLimiter(object):
+    """ Token bucket shared by all workers, with adaptive backoff.
+
+    Tokens accrue at the current rate up to `burst` and every request takes one. A throttled response halves the rate
+    and drops the saved burst, while each successful response raises it again by a twentieth of `qps`, up to `qps`.
+
+    :param qps: Maximum sustained requests per second.
+    :param burst: Maximum number of requests sent back-to-back after an idle period. Defaults to `qps`.
+
+    """
+    def __init__(self, qps, burst=None):
+        self.qps = float(qps)
+        self.burst = float(burst or qps)
+        self.rate = self.qps
+
+        self.throttle_count = 0
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+
+    def reserve(self):
+        """ Takes a token and returns the number of seconds the caller must wait before sending its request.
+
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate) - 1
+            self._updated = now
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """ Blocks until the caller may send a request.
+
+        """
+        delay = self.reserve()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self._lock:
+            self.throttle_count += 1
+            self.rate = max(self.rate / 2, MIN_RATE)
+            self._tokens = min(self._tokens, 0.0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.rate + self.qps / 20, self.qps)
@@ -0,0 +1,306 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Offline geocoding against a local gazetteer, selected with `engine=local`.
+
+The gazetteer is a GeoNames-style CSV file in the lookups directory with one row per place and these columns::
+
+    name,alternatenames,latitude,longitude,feature_class,feature_code,
+    country_code,country,admin1_code,admin1,admin2_code,admin2,population
+
+`alternatenames` is a comma-separated list; `feature_class` and `feature_code` are GeoNames feature codes (`P`/`PPL`
+for populated places, `A`/`ADM1` for first-level administrative divisions, `A`/`PCLI` for countries and so on).
+
+The CSV is compiled once into a compact index: parallel arrays of place attributes, admin hierarchy tables that store
+each country and administrative division name only once, a token inverted index over place names and a k-d tree over
+place coordinates for reverse lookups. The index is saved in the app's local directory and rebuilt whenever the CSV
+changes.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from array import array
+import cPickle as pickle
+import csv
+import os
+import re
+import tempfile
+
+from geocode_normalize import normalize_address
+from geocode_spatial import KDTree, haversine_distance
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INDEX_VERSION = 5
+
+# Output field that holds the name of a place, by GeoNames feature code
+LEVELS = {
+    "PCL": "country",
+    "PCLD": "country",
+    "PCLF": "country",
+    "PCLI": "country",
+    "PCLIX": "country",
+    "PCLS": "country",
+    "ADM1": "administrative_area_level_1",
+    "ADM2": "administrative_area_level_2",
+    "ADM3": "administrative_area_level_3",
+    "ADM4": "administrative_area_level_4",
+    "ADM5": "administrative_area_level_5",
+}
+
+_token = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return _token.findall(normalize_address(text))
+
+
+def open_gazetteer(name):
+    """ Returns the gazetteer for the file `name` in the app's lookups directory.
+
+    :raises ValueError: The file does not exist.
+
+    """
+    name = os.path.basename(name)
+    path = os.path.join(APP_ROOT, "lookups", name)
+
+    if not os.path.isfile(path):
+        raise ValueError("No gazetteer file at {}".format(path))
+
+    return Gazetteer.load(path, os.path.join(APP_ROOT, "local", name + ".index"))
+
+
+class Gazetteer(object):
+    """ In-memory place index built from a gazetteer CSV file.
+
+    Use :meth:`load` rather than the constructor; it reuses the saved index when it is current.
+
+    """
+    def __init__(self):
+        # Place attributes, indexed by place id
+        self.names = []
+        self.levels = []
+        self.lats = array(b"d")
+        self.lons = array(b"d")
+        self.populations = array(b"l")
+        self.countries = array(b"i")
+        self.admin1s = array(b"i")
+        self.admin2s = array(b"i")
+
+        # Admin hierarchy tables: (code, name, name tokens) per entry, referenced by position from the arrays above
+        self.admin_tables = {"country": [], "admin1": [], "admin2": []}
+
+        # Every name of every place as (place id, name tokens), and the inverted index from token to name ids. A name is
+        # posted only under its rarest token: a query must contain all tokens of a name to match it, so that one is
+        # enough to find it and keeps the posting lists short.
+        self.name_places = array(b"i")
+        self.name_tokens = []
+        self.postings = {}
+
+        self.tree = None
+
+    @classmethod
+    def load(cls, path, index_path):
+        """ Returns the gazetteer for the CSV file at `path`, compiling it to `index_path` if that is missing, stale or
+        unreadable.
+
+        """
+        mtime = os.path.getmtime(path)
+
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, "rb") as f:
+                    version, source_mtime, gazetteer = pickle.load(f)
+            except Exception:
+                version, source_mtime, gazetteer = None, None, None
+            if version == INDEX_VERSION and source_mtime == mtime:
+                return gazetteer
+
+        gazetteer = cls()
+        gazetteer._build(path)
+
+        directory = os.path.dirname(index_path)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Concurrent searches may compile the same index; each writes its own file and the last rename wins
+        fd, temporary = tempfile.mkstemp(prefix=os.path.basename(index_path) + ".", dir=directory or ".")
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((INDEX_VERSION, mtime, gazetteer), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, index_path)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+        return gazetteer
+
+    def _build(self, path):
+        admin_ids = {"country": {}, "admin1": {}, "admin2": {}}
+
+        def admin(table, key, code, name):
+            # The tokens of an admin entry are those of its name plus its own code, so "TX" matches Texas. Codes are
+            # normalized like addresses so they match the tokens of a query.
+            if not code:
+                return -1
+            ids = admin_ids[table]
+            if key not in ids:
+                ids[key] = len(self.admin_tables[table])
+                self.admin_tables[table].append((key, name, frozenset(tokenize(name)) | frozenset(tokenize(code))))
+            return ids[key]
+
+        with open(path, "rb") as f:
+            for row in csv.DictReader(f):
+                row = dict((k.decode("utf-8"), v.decode("utf-8")) for k, v in row.iteritems() if k and v is not None)
+                place = len(self.names)
+
+                country_code = row.get("country_code", "")
+                admin1_code = row.get("admin1_code", "")
+                admin2_code = row.get("admin2_code", "")
+
+                self.names.append(row["name"])
+                self.levels.append(LEVELS.get(row.get("feature_code", ""), "locality"))
+                self.lats.append(float(row["latitude"]))
+                self.lons.append(float(row["longitude"]))
+                self.populations.append(int(row.get("population") or 0))
+                admin1_key = country_code + "." + admin1_code
+
+                self.countries.append(admin("country", country_code, country_code, row.get("country", "")))
+                self.admin1s.append(admin("admin1", admin1_key, admin1_code, row.get("admin1", "")))
+                self.admin2s.append(admin("admin2", admin1_key + "." + admin2_code, admin2_code, row.get("admin2", "")))
+
+                names = set([normalize_address(row["name"])])
+                names.update(normalize_address(name) for name in row.get("alternatenames", "").split(",") if name)
+
+                for name in names:
+                    tokens = tuple(tokenize(name))
+                    if tokens:
+                        self.name_places.append(place)
+                        self.name_tokens.append(tokens)
+
+        frequency = {}
+
+        for tokens in self.name_tokens:
+            for token in tokens:
+                frequency[token] = frequency.get(token, 0) + 1
+
+        postings = {}
+
+        for name_id, tokens in enumerate(self.name_tokens):
+            token = min(tokens, key=frequency.get)
+            postings.setdefault(token, array(b"i")).append(name_id)
+
+        self.postings = postings
+
+        for table in self.admin_tables:
+            self.admin_tables[table] = tuple(self.admin_tables[table])
+
+        self.tree = KDTree(self.lats, self.lons)
+
+    def admin(self, table, index):
+        """ Returns the (code, name, tokens) entry of an admin hierarchy table or :const:`None`.
+
+        """
+        return self.admin_tables[table][index] if index >= 0 else None
+
+    def search(self, address):
+        """ Returns the id of the place that best matches `address` or :const:`None`.
+
+        A place matches when all tokens of one of its names appear in the address. Matches are ranked by the number of
+        address tokens they explain, counting name tokens plus the tokens of the place's country and first-level
+        administrative division that are left over, so "Paris, TX" prefers the Paris in Texas. Ties go to populated
+        places and then to the larger population.
+
+        """
+        tokens = set(tokenize(address))
+        best, best_score = None, None
+
+        for token in tokens:
+            for name_id in self.postings.get(token, ()):
+                name_tokens = self.name_tokens[name_id]
+
+                if not tokens.issuperset(name_tokens):
+                    continue
+
+                place = self.name_places[name_id]
+                remaining = tokens.difference(name_tokens)
+                score = len(name_tokens)
+
+                for table, index in ("country", self.countries[place]), ("admin1", self.admin1s[place]):
+                    entry = self.admin(table, index)
+                    if entry is not None and remaining and not remaining.isdisjoint(entry[2]):
+                        score += len(remaining.intersection(entry[2]))
+
+                score = (score, self.levels[place] == "locality", self.populations[place])
+
+                if best_score is None or score > best_score:
+                    best, best_score = place, score
+
+        return best
+
+    def geocode(self, address):
+        """ Returns the output fields for `address` in the same form as an API lookup, without viewport fields.
+
+        """
+        place = self.search(address)
+
+        if place is None:
+            return {"msg": "ZERO_RESULTS"}
+
+        return self.describe(place)
+
+    def reverse(self, lat, lon, unit):
+        """ Returns the fields of the place nearest to (`lat`, `lon`) including its distance in `unit`.
+
+        """
+        place = self.tree.nearest(lat, lon)
+
+        if place is None:
+            return {"msg": "ZERO_RESULTS"}
+
+        fields = self.describe(place)
+        fields["distance"] = haversine_distance(lat, lon, self.lats[place], self.lons[place], unit)
+        return fields
+
+    def describe(self, place):
+        """ Returns the output fields of a place: its coordinates, name, admin hierarchy and formatted address.
+
+        """
+        fields = {
+            "msg": "OK",
+            "lat": self.lats[place],
+            "lon": self.lons[place],
+        }
+
+        formatted_address = [self.names[place]]
+        fields[self.levels[place]] = self.names[place]
+
+        for table, index, field in (
+                ("admin2", self.admin2s[place], "administrative_area_level_2"),
+                ("admin1", self.admin1s[place], "administrative_area_level_1"),
+                ("country", self.countries[place], "country")):
+            entry = self.admin(table, index)
+            if entry is not None and entry[1]:
+                fields.setdefault(field, entry[1])
+                if field != "administrative_area_level_2" and entry[1] != formatted_address[-1]:
+                    formatted_address.append(entry[1])
+
+        fields["formatted_address"] = ", ".join(formatted_address)
+        return fields
@@ -0,0 +1,130 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Aggregate statistics of the geocoding command, published as job inspector metrics.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from array import array
+import math
+import threading
+import time
+
+# Latency histogram buckets grow geometrically from HISTOGRAM_MIN milliseconds, so percentiles are accurate to 5%
+HISTOGRAM_MIN = 0.01
+HISTOGRAM_GROWTH = 1.05
+HISTOGRAM_BUCKETS = int(math.ceil(math.log(10 * 60 * 1000 / HISTOGRAM_MIN, HISTOGRAM_GROWTH))) + 1
+
+
+class LatencyHistogram(object):
+    """ Fixed-size, log-scale histogram of latencies in milliseconds.
+
+    """
+    def __init__(self):
+        self.counts = array(b"l", [0] * HISTOGRAM_BUCKETS)
+        self.count = 0
+
+    def add(self, ms):
+        bucket = 0 if ms <= HISTOGRAM_MIN else int(math.log(ms / HISTOGRAM_MIN, HISTOGRAM_GROWTH)) + 1
+        self.counts[min(bucket, HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        """ Returns the upper bound in milliseconds of the bucket that holds the `p` percentile, or :const:`None`.
+
+        """
+        if self.count == 0:
+            return None
+
+        rank = int(math.ceil(self.count * p / 100))
+        seen = 0
+
+        for bucket, count in enumerate(self.counts):
+            seen += count
+
+            if seen >= rank:
+                return HISTOGRAM_MIN * HISTOGRAM_GROWTH ** bucket
+
+
+class GeocodeStats(object):
+    """ Thread-safe counters of the lookups completed over one chunk or one search.
+
+    :param workers: Number of threads or concurrent requests doing lookups.
+    :param limiter: :class:`geocode_http.RateLimiter` whose throttled responses are counted.
+
+    """
+    def __init__(self, workers, limiter):
+        self.workers = workers
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time.time()
+            self.throttle_base = self.limiter.throttle_count
+            self.sources = {}
+            self.requests = 0
+            self.retries = 0
+            self.busy = 0.0
+            self.latency = LatencyHistogram()
+
+    def record(self, source, attempts, ms):
+        """ Counts a completed lookup that came from `source` and took `attempts` requests and `ms` milliseconds.
+
+        Background refreshes of stale entries, from source "refresh", answer no record: their requests and worker time
+        are counted but they are not counted as lookups.
+
+        """
+        with self._lock:
+            self.sources[source] = self.sources.get(source, 0) + 1
+            self.requests += attempts
+            self.retries += max(attempts - 1, 0)
+
+            if source != "refresh":
+                self.latency.add(ms)
+
+            if source != "hit" and source != "stale":
+                self.busy += ms / 1000
+
+    def metrics(self):
+        """ Returns a list of (name, elapsed seconds, count) tuples. Either value may be :const:`None`.
+
+        """
+        with self._lock:
+            elapsed = time.time() - self.start
+            capacity = self.workers * elapsed
+
+            result = [
+                ("lookups", elapsed, self.latency.count),
+                ("cache_hits", None, self.sources.get("hit", 0)),
+                ("cache_stale", None, self.sources.get("stale", 0)),
+                ("cache_misses", None, self.sources.get("miss", 0)),
+                ("cache_refreshes", None, self.sources.get("refresh", 0)),
+                ("requests", self.busy, self.requests),
+                ("retries", None, self.retries),
+                ("throttled", None, self.limiter.throttle_count - self.throttle_base),
+                ("worker_utilization_pct", None, int(round(100 * min(self.busy / capacity, 1.0))) if capacity else 0),
+            ]
+
+            for p in (50, 95, 99):
+                ms = self.latency.percentile(p)
+                result.append(("latency_p{}".format(p), None if ms is None else ms / 1000, self.latency.count))
+
+        return result
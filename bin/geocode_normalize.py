@@ -0,0 +1,159 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Canonical form of addresses, used as the de-duplication and cache key of the geocoding command.
+
+Normalization is deterministic and only ever applied to keys; the address sent to the API is the raw input. Two
+addresses share a key when they differ only in case, accents, punctuation, whitespace or common abbreviations::
+
+    "270 Brannan St.,  SF"  ->  "270 brannan street sf"
+    "270 N Main St Apt 5"   ->  "270 north main street apartment 5"
+    "St. Louis, MO"         ->  "saint louis mo"
+    "Columbus NE"           ->  "columbus ne"
+    "Zürich"                ->  "zurich"
+
+Abbreviations are only expanded in the first comma-separated part of an address, where their meaning is clear from
+their position. Everything else, such as state codes ("Hartford CT", "Miami, FL"), city nicknames ("SF") or the
+letters of a possessive ("Macy's"), is kept as written.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+import unicodedata
+
+# Street types, expanded once in a street part: the first one that follows the house number ("270 Brannan St")
+STREET_TYPES = {
+    "av": "avenue",
+    "ave": "avenue",
+    "blvd": "boulevard",
+    "cir": "circle",
+    "ct": "court",
+    "dr": "drive",
+    "hwy": "highway",
+    "ln": "lane",
+    "pkwy": "parkway",
+    "pl": "place",
+    "rd": "road",
+    "sq": "square",
+    "st": "street",
+    "ter": "terrace",
+}
+
+# Directions, expanded in a street part right after the house number ("270 N Main St") or the street type ("100 Main
+# St NE")
+DIRECTIONS = {
+    "e": "east",
+    "n": "north",
+    "ne": "northeast",
+    "nw": "northwest",
+    "s": "south",
+    "se": "southeast",
+    "sw": "southwest",
+    "w": "west",
+}
+
+# Unit designators, expanded in a street part after the street type ("Main St Ste 200")
+UNITS = {
+    "apt": "apartment",
+    "ste": "suite",
+}
+
+# Abbreviations expanded when they start a place name ("St Louis", "Ft Worth") or follow the house number of a street
+# part ("270 St Marks Pl")
+LEADING_ABBREVIATIONS = {
+    "ft": "fort",
+    "mt": "mount",
+    "st": "saint",
+    "ste": "sainte",
+}
+
+_part = re.compile(r"[,;\n]+")
+_punctuation = re.compile(r"[^\w]+", re.UNICODE)
+
+
+def strip_accents(text):
+    """ Returns `text` with diacritics removed.
+
+    """
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def expand_street(tokens):
+    """ Returns the words of a street part, whose first token is a house number, with its abbreviations expanded.
+
+    """
+    words = list(tokens)
+    index = 1
+
+    # A leading word is part of the street name unless the street type follows it, as in "100 E St"
+    if index < len(words) - 1 and words[index + 1] not in STREET_TYPES:
+        word = words[index]
+
+        if word in LEADING_ABBREVIATIONS or word in DIRECTIONS:
+            words[index] = LEADING_ABBREVIATIONS.get(word) or DIRECTIONS[word]
+            index += 1
+
+    for index in range(index, len(words)):
+        if words[index] in STREET_TYPES:
+            words[index] = STREET_TYPES[words[index]]
+
+            if index + 1 < len(words) and words[index + 1] in DIRECTIONS:
+                words[index + 1] = DIRECTIONS[words[index + 1]]
+
+            words[index + 1:] = [UNITS.get(word, word) for word in words[index + 1:]]
+            break
+
+    return words
+
+
+def normalize_address(address):
+    """ Returns the canonical key of an address.
+
+    The address is case folded, stripped of accents and split into comma-separated parts and words with punctuation
+    and whitespace collapsed. In the first part, abbreviations are expanded: street types, directions and unit
+    designators when it starts with a house number, and a leading "St", "Ste", "Ft" or "Mt" of a place name otherwise.
+
+    """
+    if isinstance(address, bytes):
+        address = address.decode("utf-8", "replace")
+
+    address = address.lower()
+
+    try:
+        address.encode("ascii")
+    except UnicodeError:
+        address = strip_accents(address)
+
+    words = []
+
+    for part in _part.split(address):
+        tokens = _punctuation.sub(" ", part).split()
+
+        if not tokens:
+            continue
+
+        if not words:
+            if tokens[0][0].isdigit():
+                tokens = expand_street(tokens)
+            elif len(tokens) > 1 and tokens[0] in LEADING_ABBREVIATIONS and not tokens[1][0].isdigit():
+                tokens[0] = LEADING_ABBREVIATIONS[tokens[0]]
+
+        words.extend(tokens)
+
+    return " ".join(words)
@@ -0,0 +1,140 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Portable snapshots of the geocode result cache, to copy a warm cache between servers.
+
+A snapshot is a gzipped CSV file with the columns `key,created,value`, one row per cache entry in key order, where
+`value` is the JSON of the cached fields. The gzip header carries no timestamp, so the same entries always give the
+same bytes. The SHA-256 of the file is written next to it in `<file>.sha256`, in the format read by `sha256sum -c`.
+
+Both export and import stream the entries; neither holds the whole snapshot in memory.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import csv
+import gzip
+import hashlib
+import os
+import tempfile
+
+HEADER = ["key", "created", "value"]
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def checksum(path):
+    """ Returns the SHA-256 hex digest of the file at `path`.
+
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class HashingFile(object):
+    """ Write-only file wrapper that keeps the SHA-256 of the bytes written through it in `digest`.
+
+    """
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def export_snapshot(cache, path):
+    """ Writes every entry of `cache` to a snapshot at `path` and its checksum to `<path>.sha256`.
+
+    The snapshot is written to a temporary file in the same directory, hashed as it is written, and only replaces
+    `path` once complete.
+
+    :return: Number of entries written and the SHA-256 hex digest of the snapshot.
+
+    """
+    directory = os.path.dirname(path)
+
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Concurrent exports to the same file each write their own temporary file and the last rename wins
+    fd, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=directory or ".")
+    count = 0
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            hashing = HashingFile(f)
+            stream = gzip.GzipFile(filename="", mode="wb", fileobj=hashing, mtime=0)
+            writer = csv.writer(stream)
+            writer.writerow(HEADER)
+
+            for key, created, value in cache.entries():
+                writer.writerow([key.encode("utf-8"), repr(created), value.encode("utf-8")])
+                count += 1
+
+            stream.close()
+
+        os.rename(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+    digest = hashing.digest.hexdigest()
+
+    with open(path + ".sha256", "w") as f:
+        f.write("{}  {}\n".format(digest, os.path.basename(path)))
+
+    return count, digest
+
+
+def import_snapshot(cache, path):
+    """ Loads the snapshot at `path` into `cache` after checking it against `<path>.sha256`.
+
+    The file is read twice: once to check it, then again to load it, so that a damaged snapshot never loads part of
+    its entries. The KV Store cannot roll a partial load back.
+
+    :raises ValueError: The checksum file is missing or does not match, or the file is not a snapshot.
+    :return: Number of entries loaded and number skipped because they had expired.
+
+    """
+    try:
+        with open(path + ".sha256") as f:
+            expected = f.read().split()[0]
+    except (IOError, IndexError):
+        raise ValueError("No checksum for snapshot {} in {}.sha256".format(path, path))
+
+    if checksum(path) != expected:
+        raise ValueError("Snapshot {} does not match its checksum".format(path))
+
+    with gzip.open(path, "rb") as stream:
+        reader = csv.reader(stream)
+
+        if next(reader, None) != HEADER:
+            raise ValueError("{} is not a geocode cache snapshot".format(path))
+
+        entries = ((key.decode("utf-8"), float(created), value.decode("utf-8")) for key, created, value in reader)
+        return cache.load(entries)
@@ -0,0 +1,122 @@
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Nearest-place search for reverse geocoding.
+
+Places are indexed as points on the unit sphere in an implicit k-d tree: the coordinates are stored in flat arrays in
+tree order and each subtree is a contiguous range whose median is the splitting point, so the tree needs no node
+objects. Straight-line distance between unit vectors grows with great-circle distance, which makes the nearest point in
+3D space the nearest place on the globe.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from array import array
+import math
+
+# Ranges of at most this many points are scanned linearly instead of being split further
+LEAF_SIZE = 16
+
+EARTH_RADIUS = {"mi": 3959, "km": 6371}
+
+
+def unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+def haversine_distance(lat1, lon1, lat2, lon2, unit):
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS[unit] * math.asin(min(1.0, math.sqrt(a)))
+
+
+class KDTree(object):
+    """ Array-backed k-d tree over the places at `lats` and `lons`.
+
+    """
+    def __init__(self, lats, lons):
+        points = [unit_vector(lat, lon) + (place,) for place, (lat, lon) in enumerate(zip(lats, lons))]
+        axes = array(b"b", [0] * len(points))
+
+        stack = [(0, len(points))]
+
+        while stack:
+            lo, hi = stack.pop()
+
+            if hi - lo <= LEAF_SIZE:
+                continue
+
+            # Split on the axis with the widest spread
+            spreads = [max(p[axis] for p in points[lo:hi]) - min(p[axis] for p in points[lo:hi]) for axis in range(3)]
+            axis = spreads.index(max(spreads))
+            points[lo:hi] = sorted(points[lo:hi], key=lambda p: p[axis])
+
+            mid = (lo + hi) // 2
+            axes[mid] = axis
+            stack.append((lo, mid))
+            stack.append((mid + 1, hi))
+
+        self.axes = axes
+        self.coordinates = tuple(array(b"d", [p[axis] for p in points]) for axis in range(3))
+        self.places = array(b"i", [p[3] for p in points])
+
+    def nearest(self, lat, lon):
+        """ Returns the id of the place nearest to (`lat`, `lon`) or :const:`None` if the tree is empty.
+
+        """
+        query = unit_vector(lat, lon)
+        x, y, z = query
+        xs, ys, zs = self.coordinates
+        axes = self.axes
+
+        best, best_distance = -1, float("inf")
+        stack = [(0, len(self.places), 0.0)]
+
+        while stack:
+            lo, hi, bound = stack.pop()
+
+            if bound >= best_distance:
+                continue
+
+            if hi - lo <= LEAF_SIZE:
+                for i in range(lo, hi):
+                    distance = (xs[i] - x) ** 2 + (ys[i] - y) ** 2 + (zs[i] - z) ** 2
+                    if distance < best_distance:
+                        best, best_distance = i, distance
+                continue
+
+            mid = (lo + hi) // 2
+            distance = (xs[mid] - x) ** 2 + (ys[mid] - y) ** 2 + (zs[mid] - z) ** 2
+
+            if distance < best_distance:
+                best, best_distance = mid, distance
+
+            axis = axes[mid]
+            offset = query[axis] - self.coordinates[axis][mid]
+
+            # Visit the side of the split that holds the query first; the other side only if the split is closer
+            # than the best match found by then
+            if offset < 0:
+                stack.append((mid + 1, hi, offset * offset))
+                stack.append((lo, mid, bound))
+            else:
+                stack.append((lo, mid, offset * offset))
+                stack.append((mid + 1, hi, bound))
+
+        return self.places[best] if best >= 0 else None
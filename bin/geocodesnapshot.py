@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import app
+from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
+
+
+import os
+import sys
+import time
+from geocode_snapshot import export_snapshot, import_snapshot
+from geocoding import APP_ROOT, open_cache
+
+SNAPSHOT_DIRECTORY = os.path.join(APP_ROOT, "local", "snapshots")
+
+
+@Configuration()
+class geocodesnapshotCommand(GeneratingCommand):
+    action = Option(require=True, validate=validators.Set("export", "import"))
+    file = Option(require=False, default="geocode_cache.csv.gz")
+    cache_store = Option(require=False, default="kvstore", validate=validators.Set("kvstore", "sqlite"))
+    cache_ttl = Option(require=False, default="720:00:00", validate=validators.Duration())
+    cache_negative_ttl = Option(require=False, default="24:00:00", validate=validators.Duration())
+    cache_size = Option(require=False, default=100000, validate=validators.Integer(1))
+
+    def generate(self):
+        path = os.path.join(SNAPSHOT_DIRECTORY, os.path.basename(self.file))
+        start = time.time()
+        cache = open_cache(self.service, self.cache_store, self.cache_ttl, self.cache_size, self.cache_negative_ttl)
+
+        try:
+            if self.action == "export":
+                count, digest = export_snapshot(cache, path)
+                record = {"entries": count, "sha256": digest, "bytes": os.path.getsize(path)}
+            else:
+                loaded, skipped = import_snapshot(cache, path)
+                record = {"entries": loaded, "expired": skipped}
+        finally:
+            cache.close()
+
+        record.update({
+            "_time": time.time(),
+            "action": self.action,
+            "file": path,
+            "cache_store": self.cache_store,
+            "elapsed_s": round(time.time() - start, 3),
+        })
+        yield record
+
+if __name__ == "__main__":
+    dispatch(geocodesnapshotCommand, sys.argv, sys.stdin, sys.stdout, __name__)
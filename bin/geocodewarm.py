@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import app
+from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
+
+
+import csv
+import os
+import sys
+import time
+from geocode_cache import NEGATIVE_STATUSES
+from geocode_normalize import normalize_address
+from geocoding import APP_ROOT, geocodingCommand, open_cache
+
+# Options passed through to the geocoding command that does the work
+GEOCODING_OPTIONS = (
+    "threads", "qps", "burst", "timeout", "retries", "retry_backoff",
+    "cache_store", "cache_ttl", "cache_negative_ttl", "cache_size",
+)
+
+# Number of distinct values handed to the geocoding command at a time; each batch costs one bulk cache read
+CHUNK_SIZE = 1000
+
+WARM_FIELD = "address"
+
+
+@Configuration()
+class geocodewarmCommand(GeneratingCommand):
+    lookup = Option(require=True)
+    field = Option(require=True)
+    progress = Option(require=False, default=1000, validate=validators.Integer(1))
+    threads = Option(require=False, default=8, validate=validators.Integer())
+    qps = Option(require=False, default=50, validate=validators.Integer(1))
+    burst = Option(require=False, default=None, validate=validators.Integer(1))
+    timeout = Option(require=False, default=10, validate=validators.Float(0))
+    retries = Option(require=False, default=5, validate=validators.Integer(0))
+    retry_backoff = Option(require=False, default=1, validate=validators.Float(0))
+    cache_store = Option(require=False, default="kvstore", validate=validators.Set("kvstore", "sqlite"))
+    cache_ttl = Option(require=False, default="720:00:00", validate=validators.Duration())
+    cache_negative_ttl = Option(require=False, default="24:00:00", validate=validators.Duration())
+    cache_size = Option(require=False, default=100000, validate=validators.Integer(1))
+
+    def prepare(self):
+        self.path = os.path.join(APP_ROOT, "lookups", os.path.basename(self.lookup))
+
+        if not os.path.isfile(self.path):
+            raise ValueError("No lookup file at {}".format(self.path))
+
+        # The geocoding command runs without a cache it cannot open, which would spend quota and warm nothing
+        try:
+            open_cache(self.service, self.cache_store, self.cache_ttl, self.cache_size, self.cache_negative_ttl).close()
+        except Exception as e:
+            raise RuntimeError("Cannot open the {} cache to warm: {}".format(self.cache_store, e))
+
+        # The geocoding command does the work: cache lookups, rate limiting, retries and write-back
+        command = geocodingCommand()
+        command.options.reset()
+
+        for name in GEOCODING_OPTIONS:
+            option = self.options[name]
+
+            if option.value is not None:
+                command.options[name].value = option.validator.format(option.value)
+
+        command.options["cache"].value = "true"
+        command.options["fields"].value = "msg,cache"
+        command.options["raw_json"].value = "false"
+        command.fieldnames = [WARM_FIELD]
+        command._service = self.service
+        command.prepare()
+
+        self.geocoding = command
+
+    def generate(self):
+        command = self.geocoding
+
+        with open(self.path, "rb") as f:
+            reader = csv.DictReader(f)
+
+            if self.field not in (reader.fieldnames or []):
+                raise ValueError("Lookup file {} has no {} column".format(self.lookup, self.field))
+
+            def values():
+                """Yields a record per distinct value, ending a chunk every CHUNK_SIZE values."""
+                seen = set()
+
+                for row in reader:
+                    value = (row[self.field] or "").strip()
+                    key = normalize_address(value)
+
+                    if key and key not in seen:
+                        seen.add(key)
+                        yield {WARM_FIELD: value}
+
+                        if len(seen) % CHUNK_SIZE == 0 and command.end_of_chunk is not None:
+                            command.end_of_chunk()
+
+            start = time.time()
+            counts = {"processed": 0, "hits": 0, "misses": 0, "failed": 0}
+
+            def progress(done):
+                elapsed = time.time() - start
+                record = {"_time": time.time(), "lookup": self.lookup, "field": self.field, "done": done}
+                record.update(counts)
+                record["elapsed_s"] = round(elapsed, 3)
+                record["per_second"] = round(counts["processed"] / elapsed, 1) if elapsed > 0 else 0
+                return record
+
+            for record in command.stream(values()):
+                msg = record[WARM_FIELD + "_msg"][0]
+                counts["processed"] += 1
+
+                if record[WARM_FIELD + "_cache"][0] == "hit":
+                    counts["hits"] += 1
+                else:
+                    counts["misses"] += 1
+
+                    if msg != "OK" and msg not in NEGATIVE_STATUSES:
+                        counts["failed"] += 1
+
+                if counts["processed"] % self.progress == 0:
+                    yield progress(False)
+
+            yield progress(True)
+
+if __name__ == "__main__":
+    dispatch(geocodewarmCommand, sys.argv, sys.stdin, sys.stdout, __name__)
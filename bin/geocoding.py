@@ -17,10 +17,11 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 import app
-from splunklib.searchcommands import dispatch, StreamingCommand, Configuration, Option, validators
+from splunklib.searchcommands import dispatch, StreamingCommand, Configuration, Option, SearchMetric, validators
 
 
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 import sys
 import time
 import json
@@ -33,6 +34,11 @@ import splunk.Intersplunk
 import splunklib.client as client
 import splunklib.searchcommands as searchcommands
 import os
+from geocode_cache import KVSTORE_COLLECTION, NEGATIVE_STATUSES, GeocodeCache, KVStoreCache
+from geocode_http import DONE, RETRY, THROTTLED, RateLimiter, backoff_delay, classify, create_session
+from geocode_local import open_gazetteer
+from geocode_metrics import GeocodeStats
+from geocode_normalize import normalize_address
 
 LOG_ROTATION_LOCATION = os.environ['SPLUNK_HOME'] + "/var/log/splunk/gmap_api.log"
 LOG_ROTATION_BYTES = 1 * 1024 * 1024
@@ -45,24 +51,216 @@ handler.setFormatter(logging.Formatter("[%(levelname)s] (%(threadName)-10s) %(me
 logger.addHandler(handler)
 
 URL_BASE = "https://maps.googleapis.com/maps/api/geocode/json"
+API_KEY_REALM = "gmap_api"
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_LOCATION = os.path.join(APP_ROOT, "local", "geocode_cache.db")
+
+# https://developers.google.com/maps/documentation/geocoding/intro#Types
+OUTPUT_FIELDS = (
+    "json",
+    "time_ms",
+    "msg",
+    "attempts",
+    "cache",
+    "lat",
+    "lon",
+    "viewport_ne_lat",
+    "viewport_ne_lon",
+    "viewport_sw_lat",
+    "viewport_sw_lon",
+    "viewport_area",
+    "formatted_address",
+    "street_number",
+    "route",
+    "intersection",
+    "country",
+    "administrative_area_level_1",
+    "administrative_area_level_2",
+    "administrative_area_level_3",
+    "administrative_area_level_4",
+    "administrative_area_level_5",
+    "colloquial_area",
+    "locality",
+    "sub_locality_1",
+    "sub_locality_2",
+    "sub_locality_3",
+    "sub_locality_4",
+    "sub_locality_5",
+    "ward",
+    "sublocality",
+    "neighborhood",
+    "premise",
+    "subpremise",
+    "postal_code",
+    "postal_code_suffix",
+    "natural_feature",
+    "airport",
+    "park",
+    "point_of_interest",
+)
+
+# Address component types copied from the first result into their own output field
+ADDRESS_COMPONENT_TYPES = frozenset(OUTPUT_FIELDS[OUTPUT_FIELDS.index("street_number"):])
+
+# Number of uncached addresses looked up in the cache together. Records waiting for them are held beyond the window, so
+# this also bounds how far output lags behind input.
+CACHE_BATCH_SIZE = 1000
+
+# Number of distinct addresses whose results are remembered per search for de-duplication. Repeats of older addresses
+# are answered by the cache.
+DEDUPE_SIZE = 10000
+
+# Resolved by the first prepare() of this process and reused afterwards
+_api_key = None
+
+
+def get_api_key(service):
+    """Returns the API key stored in the gmap_api realm, looking it up only once per process."""
+    global _api_key
+
+    if _api_key is None:
+        # Ask splunkd for the gmap_api realm only instead of paging through every stored credential
+        for credential in service.storage_passwords.list(search="realm=" + API_KEY_REALM):
+            if credential.content.get("realm") == API_KEY_REALM:
+                _api_key = credential.content.get("clear_password")
+                logger.debug("Found API Key")
+                break
+        else:
+            raise RuntimeError(
+                "No API key found in the {} realm of the password store. "
+                "Run the app setup page to store one.".format(API_KEY_REALM))
+
+    return _api_key
+
+
+def open_cache(service, store, ttl, max_size, negative_ttl):
+    """Returns the result cache kept in `store`, either the KV Store or the SQLite file."""
+    if store == "kvstore":
+        return KVStoreCache(service.kvstore[KVSTORE_COLLECTION].data, ttl, max_size, negative_ttl)
+
+    return GeocodeCache(CACHE_LOCATION, ttl, max_size, negative_ttl)
 
 
 @Configuration()
 class geocodingCommand(StreamingCommand):
     threads = Option(require=False, default=8, validate=validators.Integer())
+    window = Option(require=False, default=None, validate=validators.Integer(1))
+    engine = Option(require=False, default="thread", validate=validators.Set("thread", "local"))
+    gazetteer = Option(require=False, default=None)
+    qps = Option(require=False, default=50, validate=validators.Integer(1))
+    burst = Option(require=False, default=None, validate=validators.Integer(1))
+    timeout = Option(require=False, default=10, validate=validators.Float(0))
+    retries = Option(require=False, default=5, validate=validators.Integer(0))
+    retry_backoff = Option(require=False, default=1, validate=validators.Float(0))
     null_value = Option(require=False, default="")
     unit = Option(require=False, default="mi")
+    fields = Option(require=False, default=None, validate=validators.List(validators.Set(*OUTPUT_FIELDS)))
+    raw_json = Option(require=False, default=True, validate=validators.Boolean())
+    cache = Option(require=False, default=True, validate=validators.Boolean())
+    cache_store = Option(require=False, default="kvstore", validate=validators.Set("kvstore", "sqlite"))
+    cache_ttl = Option(require=False, default="720:00:00", validate=validators.Duration())
+    cache_stale = Option(require=False, default=False, validate=validators.Boolean())
+    cache_negative_ttl = Option(require=False, default="24:00:00", validate=validators.Duration())
+    cache_size = Option(require=False, default=100000, validate=validators.Integer(1))
+
+    # Called by stream() for the addresses collected from each input chunk
+    end_of_chunk = None
+
+    # Writes the records still held by stream() once their lookups complete, so that each input chunk is answered in
+    # full
+    write_pending = None
+
+    # Statistics of the lookups completed in the current chunk and in the whole search, set by stream()
+    chunk_stats = None
+    search_stats = None
+
+    def flush(self):
+        # The record reader flushes once it has read every record of an input chunk, before reading the next one
+        if self.end_of_chunk is not None:
+            self.end_of_chunk()
+
+        if self.write_pending is not None:
+            self.write_pending()
+
+        if self.chunk_stats is not None:
+            self.write_stats()
+
+        super(geocodingCommand, self).flush()
+
+    def finish(self):
+        if self.chunk_stats is not None:
+            self.write_stats()
+            logger.info("Search totals: %s", ", ".join(
+                "{}={}".format(name, count if elapsed is None else "{}/{:.3f}s".format(count, elapsed))
+                for name, elapsed, count in self.search_stats.metrics()))
+
+        super(geocodingCommand, self).finish()
+
+    def write_stats(self):
+        """Publishes the chunk and search statistics as job inspector metrics and starts a new chunk."""
+        for scope, stats in (("chunk", self.chunk_stats), ("search", self.search_stats)):
+            for name, elapsed, count in stats.metrics():
+                self.write_metric("geocoding.{}.{}".format(scope, name), SearchMetric(elapsed, count, None, None))
+
+        self.chunk_stats.reset()
+
+    def prepare(self):
+        # requests rejects a timeout of 0 with a ValueError rather than a RequestException, which would end the search
+        if self.timeout <= 0:
+            raise ValueError("Expected timeout greater than 0, not {}".format(self.timeout))
+
+        if self.engine == "local":
+            # No gazetteer ships with the app; each site supplies its own extract
+            if self.gazetteer is None:
+                raise ValueError("engine=local requires gazetteer=<file>, a CSV file in the app's lookups directory")
+
+            self.gazetteer_index = open_gazetteer(self.gazetteer)
+        else:
+            self.APIKey = get_api_key(self.service)
+
+        self.output_fields = output_fields = [
+            output_field for output_field in OUTPUT_FIELDS
+            if (self.fields is None or output_field in self.fields) and (self.raw_json or output_field != "json")]
+
+        if not output_fields:
+            raise ValueError("No output fields selected; fields={} with raw_json=false".format(",".join(self.fields)))
+
+        # Output field names of every input field, computed once instead of per record and value:
+        # record_fields[key] lists them in output order and output_field_names[key] pairs them with their output field.
+        self.record_fields = {}
+        self.output_field_names = {}
+
+        for key in self.fieldnames:
+            self.record_fields[key] = tuple(key + "_" + output_field for output_field in output_fields)
+            self.output_field_names[key] = tuple(zip(output_fields, self.record_fields[key]))
 
     def stream(self, records):
-        service = self.service
-        storage_passwords = service.storage_passwords
+        # One limiter for all workers so the whole search stays under the configured rate
+        limiter = RateLimiter(self.qps, self.burst)
 
-        for credential in storage_passwords:
-            if credential.content.get('realm') == "gmap_api":
-                self.APIKey = credential.content.get('clear_password')
-                logger.debug("Found API Key")
+        if self.engine == "local":
+            pool, workers = None, 1
+        else:
+            pool, workers = ThreadPoolExecutor(self.threads), self.threads
+            session = create_session(self.threads)
+
+        self.chunk_stats = GeocodeStats(workers, limiter)
+        self.search_stats = GeocodeStats(workers, limiter)
+
+        # Local lookups are faster than the cache itself
+        use_cache = self.cache and self.engine != "local"
+
+        cache = None
+
+        if use_cache:
+            # The KV Store can be disabled or unreachable, as on indexers; the search then runs without a cache
+            try:
+                cache = open_cache(
+                    self.service, self.cache_store, self.cache_ttl, self.cache_size, self.cache_negative_ttl)
+            except Exception as e:
+                logger.warning("Cannot open the %s cache, geocoding without it: %s", self.cache_store, e)
 
-        pool = ThreadPoolExecutor(self.threads)
         def haversine_area(lat1, lon1, lat2, lon2, unit):
             r = 3959 if unit == "mi" else 6371
             lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
@@ -74,59 +272,243 @@ class geocodingCommand(StreamingCommand):
 
             return r**2 * abs(math.sin(lat1) - math.sin(lat2)) * abs(lon1 - lon2)
 
+        def request_params(address):
+            URL_PARAMS = {
+                "key": self.APIKey,
+            }
+            params = URL_PARAMS.copy()
+            params.update({
+                "address": address
+            })
+            return params
+
+        def parse(r_json, text):
+            """Returns the output fields of a decoded API response, without viewport_area."""
+            fields = {}
+            status = r_json["status"]
+            fields["json"] = text
+            fields["msg"] = status
+
+            #logger.debug("response: " + text)
+            #logger.debug("status: " + status)
+
+            if status == "OK":
+                #logger.debug("result count: " + str(len(r_json["results"])))
+                result = r_json["results"][0]
+
+                fields["lat"] = result["geometry"]["location"]["lat"]
+                fields["lon"] = result["geometry"]["location"]["lng"]
+                fields["formatted_address"] = result["formatted_address"]
+                fields["viewport_ne_lat"] = result["geometry"]["viewport"]["northeast"]["lat"]
+                fields["viewport_ne_lon"] = result["geometry"]["viewport"]["northeast"]["lng"]
+                fields["viewport_sw_lat"] = result["geometry"]["viewport"]["southwest"]["lat"]
+                fields["viewport_sw_lon"] = result["geometry"]["viewport"]["southwest"]["lng"]
+
+                for component in result["address_components"]:
+                    name = component["types"][0]
+
+                    if name in ADDRESS_COMPONENT_TYPES:
+                        fields[name] = component["long_name"]
+
+            return fields
+
+        def lookup(address):
+            """Queries the API for a single address and returns its output fields, without viewport_area.
+
+            Transient failures are retried up to `retries` times with jittered backoff, each attempt waiting for the
+            rate limiter. The number of attempts made is returned in the attempts field.
+            """
+            params = request_params(address)
+
+            for attempt in range(1, self.retries + 2):
+                if attempt > 1:
+                    time.sleep(backoff_delay(attempt - 1, self.retry_backoff))
+
+                limiter.acquire()
+
+                try:
+                    r = session.get(URL_BASE, params=params, timeout=self.timeout)
+
+                    #logger.info("url: " + r.url)
+
+                    r.raise_for_status()
+                    fields = parse(r.json(), r.text)
+                    outcome = classify(fields["msg"])
+
+                except requests.exceptions.HTTPError as err:
+                    fields = {"msg": err}
+                    outcome = classify(err.response.status_code if err.response is not None else None)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    fields = {"msg": e}
+                    outcome = RETRY
+                except requests.exceptions.RequestException as e:
+                    fields = {"msg": e}
+                    outcome = DONE
+                except (ValueError, KeyError, IndexError) as e:
+                    # A body that is not JSON or lacks the expected keys, as sent by proxies and overloaded servers
+                    fields = {"msg": "Malformed response: {!r}".format(e)}
+                    outcome = RETRY
+
+                fields["attempts"] = attempt
+
+                if outcome == DONE:
+                    limiter.succeeded()
+                    return fields
+
+                if outcome == THROTTLED:
+                    limiter.throttled()
+
+                logger.warning("Attempt %d failed for address %r: %s", attempt, address, fields["msg"])
+
+            return fields
+
+        def complete(cache_key, fields, start, source):
+            """Caches the result of a lookup, adds the fields that are never cached and returns the output fields.
+
+            `source` is "miss" for a result fetched from the API, which is cached, "refresh" for one fetched to refresh
+            a stale entry, which is cached but answers no record, "hit" or "stale" for a result read from the cache, or
+            None for a gazetteer lookup.
+            """
+            attempts = fields.pop("attempts", 0)
+            store = source == "miss" or source == "refresh"
+
+            # Successful lookups and addresses the API cannot resolve are cached; transient errors are retried next
+            # time.
+            status = fields.get("msg")
+
+            if store and cache is not None and (
+                    status == "OK" or status in NEGATIVE_STATUSES and self.cache_negative_ttl > 0):
+                cache.set(cache_key, fields)
+
+            fields["attempts"] = attempts
+
+            if cache is not None:
+                fields["cache"] = source
+
+            if "viewport_ne_lat" in fields:
+                # viewport_area depends on the unit option so it is never cached
+                fields["viewport_area"] = haversine_area(
+                    fields["viewport_ne_lat"], fields["viewport_ne_lon"],
+                    fields["viewport_sw_lat"], fields["viewport_sw_lon"],
+                    self.unit)
+
+            fields["time_ms"] = (time.time() - start) * 1000
+
+            for stats in (self.chunk_stats, self.search_stats):
+                stats.record(source, attempts, fields["time_ms"])
+
+            # Results are kept for de-duplication until the end of the search, so they hold the selected output fields
+            # only, and the raw response only with raw_json=true
+            return dict((name, fields[name]) for name in self.output_fields if name in fields)
+
+        def geocode(cache_key, address, source):
+            """Returns the output fields for a single address that is not cached."""
+            start = time.time()
+            return complete(cache_key, lookup(address), start, source)
+
+        def dispatch(cache_key, address, source="miss"):
+            """Starts the lookup of an address that is not cached and returns a Future of its output fields."""
+            if pool is not None:
+                return pool.submit(geocode, cache_key, address, source)
+
+            start = time.time()
+            future = Future()
+            future.set_result(complete(cache_key, self.gazetteer_index.geocode(address), start, None))
+            return future
+
+        def chain(source, target):
+            """Completes the Future `target` with the outcome of the Future `source`."""
+            def copy(source):
+                error = source.exception()
+
+                if error is not None:
+                    target.set_exception(error)
+                else:
+                    target.set_result(source.result())
+
+            source.add_done_callback(copy)
+
+        # Addresses waiting for a cache lookup, as (cache_key, address, future) tuples. They are looked up together
+        # once CACHE_BATCH_SIZE of them are queued and at the end of each input chunk, so only true misses reach the
+        # API.
+        queued = []
+
+        # Lookups that refresh the expired entries served with cache_stale=true
+        refreshes = []
+
+        def lookup_queued():
+            """Resolves the queued addresses from the cache in bulk and dispatches the misses."""
+            if not queued:
+                return
+
+            start = time.time()
+            found = cache.get_many([cache_key for cache_key, _, _ in queued], self.cache_stale)
+
+            for cache_key, address, future in queued:
+                entry = found.get(cache_key)
+
+                if entry is None:
+                    chain(dispatch(cache_key, address), future)
+                    continue
+
+                fields, fresh = entry
+                future.set_result(complete(cache_key, fields, start, "hit" if fresh else "stale"))
+
+                if not fresh:
+                    # Refreshed in the background through the same rate limiter; the result only updates the cache
+                    refreshes.append(dispatch(cache_key, address, "refresh"))
+
+            del queued[:]
+
+        if cache is not None:
+            self.end_of_chunk = lookup_queued
+
+        # Every distinct address is geocoded once per search. Records that repeat an address share the Future of
+        # its first occurrence, in this chunk or any earlier one.
+        resolved = OrderedDict()
+
+        # Cache keys of the raw addresses seen, as most repeated addresses are spelled the same way
+        keys = {}
+
+        def submit(address):
+            cache_key = keys.get(address)
+
+            if cache_key is None:
+                if len(keys) >= DEDUPE_SIZE:
+                    keys.clear()
+
+                cache_key = keys[address] = normalize_address(address)
+
+            future = resolved.get(cache_key)
+
+            if future is None:
+                if cache is None:
+                    future = dispatch(cache_key, address)
+                else:
+                    future = Future()
+                    queued.append((cache_key, address, future))
+
+                resolved[cache_key] = future
+
+                if len(resolved) > DEDUPE_SIZE:
+                    resolved.popitem(last=False)
+
+            return future
+
         def geocoding_query(record):
-            # https://developers.google.com/maps/documentation/geocoding/intro#Types
-            output_fields = [
-                "json",
-                "time_ms",
-                "msg",
-                "lat",
-                "lon",
-                "viewport_ne_lat",
-                "viewport_ne_lon",
-                "viewport_sw_lat",
-                "viewport_sw_lon",
-                "viewport_area",
-                "formatted_address",
-                "street_number",
-                "route",
-                "intersection",
-                "country",
-                "administrative_area_level_1",
-                "administrative_area_level_2",
-                "administrative_area_level_3",
-                "administrative_area_level_4",
-                "administrative_area_level_5",
-                "colloquial_area",
-                "locality",
-                "sub_locality_1",
-                "sub_locality_2",
-                "sub_locality_3",
-                "sub_locality_4",
-                "sub_locality_5",
-                "ward",
-                "sublocality",
-                "neighborhood",
-                "premise",
-                "subpremise",
-                "postal_code",
-                "postal_code_suffix",
-                "natural_feature",
-                "airport",
-                "park",
-                "point_of_interest",
-            ]
+            """Initializes the output fields of a record and returns the lookups that will fill them."""
+            lookups = []
+            null_value = self.null_value
 
             for key in self.fieldnames:
                 # You have to set all possible output fields to ""
                 # otherwise if the first row doesn't set the fields
                 # then the rest of the rows can't set it.
 
+                fields = self.record_fields[key]
                 values = record[key]
 
-                for output_field in output_fields:
-                    field = key + "_" + output_field
-
+                for field in fields:
                     if values or field not in record:
                         record[field] = []
 
@@ -137,89 +519,74 @@ class geocodingCommand(StreamingCommand):
                     address = value.strip()
 
                     if address:
-                        for output_field in output_fields:
-                            field = key + "_" + output_field
-                            record[field].append(self.null_value)
-
-                        URL_PARAMS = {
-                            "key": self.APIKey,
-                        }
-                        params = URL_PARAMS.copy()
-                        params.update({
-                            "address": address
-                        })
-
-                        try:
-                            start = time.time()
-                            r = requests.get(URL_BASE, params=params)
-                            record[key + "_time_ms"][-1] = (time.time() - start) * 1000
-
-                            r.raise_for_status()
-                            r_json = r.json()
-                            status = r_json["status"]
-                            record[key + "_json"][-1] = r.text
-                            record[key + "_msg"][-1] = status
-
-                            #logger.info("url: " + r.url)
-                            #logger.debug("response: " + r.text)
-                            #logger.debug("status: " + status)
-
-                            if status == "OK":
-                                #logger.debug("result count: " + str(len(r_json["results"])))
-                                result = r_json["results"][0]
-
-                                record[key + "_lat"][-1] = result["geometry"]["location"]["lat"]
-                                record[key + "_lon"][-1] = result["geometry"]["location"]["lng"]
-                                record[key + "_formatted_address"][-1] = result["formatted_address"]
-
-                                lat1 = result["geometry"]["viewport"]["northeast"]["lat"]
-                                lon1 = result["geometry"]["viewport"]["northeast"]["lng"]
-                                lat2 = result["geometry"]["viewport"]["southwest"]["lat"]
-                                lon2 = result["geometry"]["viewport"]["southwest"]["lng"]
-
-                                record[key + "_viewport_ne_lat"][-1] = lat1
-                                record[key + "_viewport_ne_lon"][-1] = lon1
-                                record[key + "_viewport_sw_lat"][-1] = lat2
-                                record[key + "_viewport_sw_lon"][-1] = lon2
-                                record[key + "_viewport_area"][-1] = haversine_area(lat1, lon1, lat2, lon2, self.unit)
-
-                                for component in result["address_components"]:
-                                    name = component["types"][0]
-
-                                    if name in output_fields:
-                                        record[key + "_" + name][-1] = component["long_name"]
-
-                        except requests.exceptions.HTTPError as err:
-                            record[key + "_msg"][-1] = err
-                            pass
-                        except requests.exceptions.RequestException as e:
-                            record[key + "_msg"][-1] = e
-                            pass
+                        for field in fields:
+                            record[field].append(null_value)
+
+                        lookups.append((self.output_field_names[key], len(record[fields[0]]) - 1, submit(address)))
+
+            return record, lookups
+
+        def fill(record, lookups):
+            """Copies the geocoded fields of each lookup into its multivalue slot of the record."""
+            for names, index, future in lookups:
+                result = future.result()
+
+                for output_field, field in names:
+                    if output_field in result:
+                        record[field][index] = result[output_field]
 
             return record
 
-        def thread(records):
-            chunk = []
+        # Records in flight, as geocoding_query() returns them
+        pending = deque()
+
+        def write_pending():
+            """Writes the records in flight at the end of an input chunk, before its output is flushed."""
+            while pending:
+                self._record_writer.write_record(fill(*pending.popleft()))
+
+        self.write_pending = write_pending
+
+        def pipeline(records):
+            """Yields geocoded records in input order while keeping up to `window` records in flight.
+
+            A record is emitted as soon as it and every record before it are complete, so one slow address only holds
+            back its successors while the pool keeps working on the rest of the window.
+            """
+            window = self.window or workers * 8
+
             for record in records:
-                chunk.append(pool.submit(geocoding_query, record))
+                pending.append(geocoding_query(record))
+
+                if len(queued) >= CACHE_BATCH_SIZE:
+                    lookup_queued()
 
-                if len(chunk) >= self.threads:
-                    yield chunk
-                    chunk = []
+                while pending:
+                    # Records whose addresses wait for the next cache lookup are held beyond the window, up to
+                    # CACHE_BATCH_SIZE addresses.
+                    if not all(f.done() for _, _, f in pending[0][1]) and (len(pending) <= window or queued):
+                        break
 
-            if chunk:
-                yield chunk
+                    yield fill(*pending.popleft())
 
-        def unchunk(chunk_gen):
-            """Flattens a generator of Future chunks into a generator of Future results."""
-            for chunk in chunk_gen:
-                for f in chunk:
-                    yield f.result() # get result from Future
+            lookup_queued()
+
+            while pending:
+                yield fill(*pending.popleft())
 
         # Now iterate over all results in same order as records
-        for result in unchunk(thread(records)):
+        for result in pipeline(records):
             yield result
 
+        # Let the refreshes reach the cache before the search ends
+        wait(refreshes)
+
+        if pool is not None:
+            session.close()
+
+        if cache is not None:
+            cache.close()
+
 if __name__ == "__main__":
     dispatch(geocodingCommand, sys.argv, sys.stdin, sys.stdout, __name__)
 
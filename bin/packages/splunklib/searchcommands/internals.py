@@ -16,15 +16,16 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from collections import deque, namedtuple
+from collections import MutableMapping, deque, namedtuple
 try:
     from collections import OrderedDict  # must be python 2.7
 except ImportError:
     from splunklib.ordereddict import OrderedDict
 from cStringIO import StringIO
-from itertools import chain, imap
+from itertools import chain, imap, izip
 from json import JSONDecoder, JSONEncoder
 from json.encoder import encode_basestring_ascii as json_encode_string
+from operator import methodcaller
 from urllib import unquote
 
 import csv
@@ -51,6 +52,50 @@ if sys.platform == 'win32':
         setmode(fileno, os.O_BINARY)
 
 
+class BoundedReader(object):
+    """ Reads at most `length` bytes of a file, line by line.
+
+    Lets :class:`csv.reader` parse the body of a chunk straight from the input stream instead of from a copy of the
+    whole body. Parsing starts with the first line and stops at the end of the body, however long the lines are.
+
+    """
+    def __init__(self, ifile, length):
+        self._ifile = ifile
+        self.length = length
+        self.remaining = length
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def next(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        line = self._ifile.readline(self.remaining)
+        if len(line) == 0:
+            self.remaining = 0  # end of file; like file.read, a short body is not an error here
+            raise StopIteration
+        self.remaining -= len(line)
+        return line
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        value = self._ifile.read(size) if size > 0 else b''
+        self.remaining = 0 if len(value) < size else self.remaining - len(value)
+        return value
+
+    def drain(self):
+        """ Skips the unread part of the body, leaving the file positioned at the start of the next chunk.
+
+        """
+        while self.remaining > 0:
+            if len(self.read(min(self.remaining, 65536))) == 0:
+                break
+
+
 class CommandLineParser(object):
     """ Parses the arguments to a search command.
 
@@ -425,6 +470,148 @@ class ObjectView(object):
         return str(self.__dict__)
 
 
+_missing = object()  # value of a field deleted from a record or added to the header by another record
+
+
+class RecordHeader(object):
+    """ Field names shared by the records read from one chunk, with the position of each name in their value lists.
+
+    Names added to any record are appended here, so records that gain the same fields in the same order, as the
+    records a streaming command processes do, also share their positions.
+
+    """
+    __slots__ = ('names', 'indexes')
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.indexes = dict((name, index) for index, name in enumerate(self.names))
+
+    def add(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            index = self.indexes[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+
+class Record(object):
+    """ Mapping over a list of values whose field names are held by a :class:`RecordHeader` shared with other records.
+
+    A record costs one small object on top of its value list, which is the row read from the input, instead of a hash
+    table and a linked list per row. Fields are ordered by their position in the header. Values past the end of the
+    list, and values of deleted fields, are missing.
+
+    """
+    __slots__ = ('_header', '_values')
+
+    def __init__(self, header, values):
+        self._header = header
+        self._values = values
+
+    def __contains__(self, name):
+        index = self._header.indexes.get(name)
+        return index is not None and index < len(self._values) and self._values[index] is not _missing
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._values[self._header.indexes[name]] = _missing
+
+    def __eq__(self, other):
+        if not isinstance(other, (Record, dict)):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __getitem__(self, name):
+        index = self._header.indexes.get(name)
+        if index is not None and index < len(self._values):
+            value = self._values[index]
+            if value is not _missing:
+                return value
+        raise KeyError(name)
+
+    __hash__ = None
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return len(self._values) - self._values.count(_missing)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return 'Record({!r})'.format(self.items())
+
+    def __setitem__(self, name, value):
+        index = self._header.add(name)
+        values = self._values
+        if index >= len(values):
+            values.extend([_missing] * (index + 1 - len(values)))
+        values[index] = value
+
+    def clear(self):
+        del self._values[:]
+
+    def copy(self):
+        return Record(self._header, list(self._values))
+
+    def get(self, name, default=None):
+        index = self._header.indexes.get(name)
+        if index is not None and index < len(self._values):
+            value = self._values[index]
+            if value is not _missing:
+                return value
+        return default
+
+    def has_key(self, name):
+        return name in self
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        return ((name, value) for name, value in izip(self._header.names, self._values) if value is not _missing)
+
+    def iterkeys(self):
+        return (name for name, value in izip(self._header.names, self._values) if value is not _missing)
+
+    def itervalues(self):
+        return (value for value in self._values if value is not _missing)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def pop(self, name, *default):
+        if name in self:
+            value = self[name]
+            del self[name]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(name)
+
+    def setdefault(self, name, default=None):
+        if name in self:
+            return self[name]
+        self[name] = default
+        return default
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+        for name, value in chain(other, kwargs.iteritems()):
+            self[name] = value
+
+    def values(self):
+        return list(self.itervalues())
+
+
+MutableMapping.register(Record)
+
+
 class Recorder(object):
 
     def __init__(self, path, f):
@@ -470,6 +657,7 @@ class RecordWriter(object):
 
         self._ofile = ofile
         self._fieldnames = None
+        self._record_header = None
         self._buffer = StringIO()
 
         self._writer = csv.writer(self._buffer, dialect=CsvDialect)
@@ -513,6 +701,51 @@ class RecordWriter(object):
         self._ensure_validity()
         self._write_record(record)
 
+    def write_columns(self, fieldnames, columns):
+        """ Writes records given column-wise: `columns` holds one sequence of values per name in `fieldnames`.
+
+        Each column is encoded as a whole: a column of strings, numbers and booleans, alone or in one-element lists, is
+        mapped through the encoders of their types and any other column is encoded value by value. The rows are then
+        written in one call per chunk. Columns are matched by name to the fieldnames of records already written in the
+        current chunk; those that are missing are written empty and the others are dropped, as they are for records.
+
+        :raises ValueError: The number of columns does not match the number of fieldnames or their lengths differ.
+
+        """
+        self._ensure_validity()
+
+        if len(columns) != len(fieldnames):
+            raise ValueError('Expected {} columns, not {}'.format(len(fieldnames), len(columns)))
+
+        count = len(columns[0]) if columns else 0
+
+        if any(len(column) != count for column in columns):
+            raise ValueError('Columns must have the same length')
+
+        if count == 0:
+            return
+
+        encoded_columns = dict(izip(fieldnames, imap(self._encode_column, columns)))
+        empty_column = [None] * count
+        fieldnames = OrderedDict.fromkeys(fieldnames).keys()
+        writerows = self._writer.writerows
+        start = 0
+
+        while start < count:
+            if self._fieldnames is None:
+                self._fieldnames = fieldnames
+                self._record_header = None
+                self._write_fieldnames(fieldnames)
+            encoded = []
+            for fieldname in self._fieldnames:
+                encoded += encoded_columns.get(fieldname, (empty_column, empty_column))
+            stop = min(count, start + self._maxresultrows - self._record_count)
+            writerows(izip(*[column[start:stop] for column in encoded]))
+            self._record_count += stop - start
+            start = stop
+            if self._record_count >= self._maxresultrows:
+                self.flush(partial=True)
+
     def write_records(self, records):
         self._ensure_validity()
         write_record = self._write_record
@@ -537,21 +770,72 @@ class RecordWriter(object):
 
         if fieldnames is None:
             self._fieldnames = fieldnames = record.keys()
-            value_list = imap(lambda fn: unicode(fn).encode('utf-8'), fieldnames)
-            value_list = imap(lambda fn: (fn, b'__mv_' + fn), value_list)
-            self._writerow(list(chain.from_iterable(value_list)))
+            self._record_header = None
+            self._write_fieldnames(fieldnames)
+
+        # Records that share a header whose leading names are the fieldnames hold their values in fieldname order. That
+        # is checked once per header and chunk, after which their values are read by position instead of by name.
+
+        if type(record) is Record:
+            header = record._header
+            if self._record_header is None or self._record_header[0] is not header:
+                self._record_header = header, header.names[:len(fieldnames)] == fieldnames
+            if self._record_header[1]:
+                field_values = record._values[:len(fieldnames)]
+                if len(field_values) < len(fieldnames):
+                    field_values += [None] * (len(fieldnames) - len(field_values))
+            else:
+                field_values = imap(record.get, fieldnames)
+        else:
+            field_values = imap(record.get, fieldnames)
+
+        self._writerow(self._encode_values(field_values))
+        self._record_count += 1
 
-        get_value = record.get
+        if self._record_count >= self._maxresultrows:
+            self.flush(partial=True)
+
+    def _write_fieldnames(self, fieldnames):
+        value_list = imap(lambda fn: unicode(fn).encode('utf-8'), fieldnames)
+        value_list = imap(lambda fn: (fn, b'__mv_' + fn), value_list)
+        self._writerow(list(chain.from_iterable(value_list)))
+
+    def _encode_column(self, column):
+        # Returns the single value and multivalue encodings of the values in column as two lists
+        encoders = self._encoders
+        value_types = frozenset(imap(type, column))
+
+        if value_types.issubset(encoders):
+            if len(value_types) == 1:
+                encode = encoders[next(iter(value_types))]
+                return map(encode, column), [None] * len(column)
+            return [encoders[type(value)](value) for value in column], [None] * len(column)
+
+        if value_types.issubset((list, tuple)) and all(len(value) == 1 for value in column):
+            values = [value[0] for value in column]
+            if frozenset(imap(type, values)).issubset(encoders):
+                return self._encode_column(values)
+
+        values = self._encode_values(column)
+        return values[0::2], values[1::2]
+
+    def _encode_values(self, field_values):
+        # Returns the single value and multivalue encodings of each value in field_values, flattened into one list
+        encoders = self._encoders
         values = []
 
-        for fieldname in fieldnames:
-            value = get_value(fieldname, None)
+        for value in field_values:
 
-            if value is None:
+            if value is None or value is _missing:
                 values += (None, None)
                 continue
 
             value_t = type(value)
+            encode = encoders.get(value_t)
+
+            if encode is not None:
+                values += (encode(value), None)
+                continue
 
             if issubclass(value_t, (list, tuple)):
 
@@ -560,68 +844,50 @@ class RecordWriter(object):
                     continue
 
                 if len(value) > 1:
-                    value_list = value
-                    sv = b''
-                    mv = b'$'
-
-                    for value in value_list:
-
-                        if value is None:
-                            sv += b'\n'
-                            mv += b'$;$'
-                            continue
-
-                        value_t = type(value)
-
-                        if value_t is not bytes:
-
-                            if value_t is bool:
-                                value = str(value.real)
-                            elif value_t is unicode:
-                                value = value.encode('utf-8', errors='backslashreplace')
-                            elif value_t is int or value_t is long or value_t is float or value_t is complex:
-                                value = str(value)
-                            elif issubclass(value_t, (dict, list, tuple)):
-                                value = str(''.join(RecordWriter._iterencode_json(value, 0)))
-                            else:
-                                value = repr(value).encode('utf-8', errors='backslashreplace')
-
-                        sv += value + b'\n'
-                        mv += value.replace(b'$', b'$$') + b'$;$'
-
-                    values += (sv[:-1], mv[:-2])
+                    value_list = [
+                        b'' if item is None else encoders.get(type(item), RecordWriter._encode_item)(item)
+                        for item in value]
+                    values += (
+                        b'\n'.join(value_list),
+                        b'$' + b'$;$'.join([item.replace(b'$', b'$$') for item in value_list]) + b'$')
                     continue
 
                 value = value[0]
-                value_t = type(value)
-
-            if value_t is bool:
-                values += (str(value.real), None)
-                continue
+                encode = encoders.get(type(value))
 
-            if value_t is bytes:
-                values += (value, None)
-                continue
+                if encode is not None:
+                    values += (encode(value), None)
+                    continue
 
-            if value_t is unicode:
-                values += (value.encode('utf-8', errors='backslashreplace'), None)
-                continue
+            values += (RecordWriter._encode_scalar(value), None)
 
-            if value_t is int or value_t is long or value_t is float or value_t is complex:
-                values += (str(value), None)
-                continue
+        return values
 
-            if issubclass(value_t, dict):
-                values += (str(''.join(RecordWriter._iterencode_json(value, 0))), None)
-                continue
+    # Encoders of the value types that are written as they are, by exact type. str returns a byte string itself.
 
-            values += (repr(value).encode('utf-8', errors='backslashreplace'), None)
+    _encoders = {
+        bool: lambda value: str(value.real),
+        bytes: str,
+        unicode: methodcaller('encode', 'utf-8', 'backslashreplace'),
+        int: str,
+        long: str,
+        float: str,
+        complex: str
+    }
 
-        self._writerow(values)
-        self._record_count += 1
+    @staticmethod
+    def _encode_item(value):
+        # Encodes a multivalue item of a type without an encoder
+        if issubclass(type(value), (dict, list, tuple)):
+            return str(''.join(RecordWriter._iterencode_json(value, 0)))
+        return repr(value).encode('utf-8', errors='backslashreplace')
 
-        if self._record_count >= self._maxresultrows:
-            self.flush(partial=True)
+    @staticmethod
+    def _encode_scalar(value):
+        # Encodes a single value of a type without an encoder
+        if issubclass(type(value), dict):
+            return str(''.join(RecordWriter._iterencode_json(value, 0)))
+        return repr(value).encode('utf-8', errors='backslashreplace')
 
     try:
         # noinspection PyUnresolvedReferences
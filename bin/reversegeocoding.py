@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2011-2015 Splunk, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"): you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import app
+from splunklib.searchcommands import dispatch, StreamingCommand, Configuration, Option, validators
+
+
+import sys
+from geocode_local import open_gazetteer
+
+OUTPUT_FIELDS = (
+    "msg",
+    "distance",
+    "lat",
+    "lon",
+    "formatted_address",
+    "locality",
+    "administrative_area_level_3",
+    "administrative_area_level_2",
+    "administrative_area_level_1",
+    "country",
+)
+
+# Number of distinct coordinate pairs whose results are remembered per search
+MEMO_SIZE = 100000
+
+
+@Configuration()
+class reversegeocodingCommand(StreamingCommand):
+    lat = Option(require=True, validate=validators.Fieldname())
+    lon = Option(require=True, validate=validators.Fieldname())
+    prefix = Option(require=False, default="reverse", validate=validators.Fieldname())
+    gazetteer = Option(require=True)
+    null_value = Option(require=False, default="")
+    unit = Option(require=False, default="mi", validate=validators.Set("mi", "km"))
+
+    def prepare(self):
+        self.gazetteer_index = open_gazetteer(self.gazetteer)
+        self.output_field_names = tuple((output_field, self.prefix + "_" + output_field) for output_field in OUTPUT_FIELDS)
+
+    def stream(self, records):
+        memo = {}
+
+        def reverse(lat, lon):
+            key = (lat, lon)
+            fields = memo.get(key)
+
+            if fields is None:
+                try:
+                    fields = self.gazetteer_index.reverse(float(lat), float(lon), self.unit)
+                except ValueError:
+                    fields = {"msg": "INVALID_REQUEST"}
+
+                if len(memo) >= MEMO_SIZE:
+                    memo.clear()
+                memo[key] = fields
+
+            return fields
+
+        for record in records:
+            lats, lons = record.get(self.lat), record.get(self.lon)
+
+            # Every output field is set on every record: the output header is taken from the first record of a chunk,
+            # so fields missing from it would be dropped from the whole chunk.
+            for output_field, name in self.output_field_names:
+                record[name] = self.null_value
+
+            if lats and lons:
+                multivalue = isinstance(lats, list) or isinstance(lons, list)
+                lats = lats if isinstance(lats, list) else [lats]
+                lons = lons if isinstance(lons, list) else [lons]
+                results = [reverse(lat, lon) for lat, lon in zip(lats, lons)]
+
+                for output_field, name in self.output_field_names:
+                    values = [result.get(output_field, self.null_value) for result in results]
+                    record[name] = values if multivalue else values[0]
+
+            yield record
+
+if __name__ == "__main__":
+    dispatch(reversegeocodingCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -27,8 +27,8 @@ try:
 except ImportError:
     from splunklib.ordereddict import OrderedDict
 from copy import deepcopy
-from cStringIO import StringIO
 from itertools import chain, ifilter, imap, islice, izip
+from operator import itemgetter
 from logging import _levelNames, getLevelName, getLogger
 try:
     from shutil import make_archive
@@ -51,6 +51,7 @@ import traceback
 # Relative imports
 
 from . internals import (
+    BoundedReader,
     CommandLineParser,
     CsvDialect,
     InputHeader,
@@ -58,6 +59,8 @@ from . internals import (
     MetadataDecoder,
     MetadataEncoder,
     ObjectView,
+    Record,
+    RecordHeader,
     Recorder,
     RecordWriterV1,
     RecordWriterV2,
@@ -657,6 +660,8 @@ class SearchCommand(object):
             if len(body) > 0:
                 raise RuntimeError('Did not expect data for getinfo action')
 
+            body.drain()
+
             self._metadata = deepcopy(metadata)
 
             searchinfo = self._metadata.searchinfo
@@ -819,8 +824,77 @@ class SearchCommand(object):
 
     @staticmethod
     def _decode_list(mv):
+        if len(mv) > 1 and mv[0] == '$' and mv[-1] == '$' and '$$' not in mv:
+            return mv[1:-1].split('$;$')  # no escaped or empty items, so the separators are unambiguous
         return [match.replace('$$', '$') for match in SearchCommand._encoded_value.findall(mv)]
 
+    @staticmethod
+    def _record_decoder(fieldnames):
+        """ Returns a function that converts a row of CSV values under `fieldnames` into a record.
+
+        The header is analyzed once per chunk and records are :class:`Record` objects that share it. Rows without
+        multivalue columns become the value lists of their records as they are. Otherwise the single-value columns are
+        picked by precomputed index and only non-empty `__mv_` cells are decoded, which is possible whenever every
+        `__mv_` column follows the column it encodes, as it does in Splunk output. Other headers, and rows that do not
+        match their header's width, are decoded column by column into an :class:`OrderedDict`.
+
+        """
+        if not any(name.startswith('__mv_') for name in fieldnames):
+            if len(set(fieldnames)) < len(fieldnames):
+                return lambda values: OrderedDict(izip(fieldnames, values))
+
+            header = RecordHeader(fieldnames)
+            width = len(fieldnames)
+
+            def decode_row(values):
+                if len(values) > width:
+                    del values[width:]
+                return Record(header, values)
+
+            return decode_row
+
+        decode_list = SearchCommand._decode_list
+
+        def decode_columns(values):
+            record = OrderedDict()
+            for fieldname, value in izip(fieldnames, values):
+                if fieldname.startswith('__mv_'):
+                    if len(value) > 0:
+                        record[fieldname[len('__mv_'):]] = decode_list(value)
+                elif fieldname not in record:
+                    record[fieldname] = value
+            return record
+
+        names, indexes, multivalue_columns, indexes_by_name = [], [], [], {}
+
+        for index, fieldname in enumerate(fieldnames):
+            if fieldname.startswith('__mv_'):
+                name = fieldname[len('__mv_'):]
+                if name not in indexes_by_name:
+                    return decode_columns
+                multivalue_columns.append((index, name))
+            elif fieldname not in indexes_by_name:
+                indexes_by_name[fieldname] = index
+                names.append(fieldname)
+                indexes.append(index)
+
+        header = RecordHeader(names)
+        multivalue_columns = [(index, header.indexes[name]) for index, name in multivalue_columns]
+        width = len(fieldnames)
+        select = itemgetter(*indexes) if len(indexes) > 1 else lambda values: (values[indexes[0]],)
+
+        def decode(values):
+            if len(values) != width:
+                return decode_columns(values)
+            record = list(select(values))
+            for index, position in multivalue_columns:
+                value = values[index]
+                if value:
+                    record[position] = decode_list(value)
+            return Record(header, record)
+
+        return decode
+
     _encoded_value = re.compile(r'\$(?P<item>(?:\$\$|[^$])*)\$(?:;|$)')  # matches a single value in an encoded list
 
     def _execute(self, ifile, process):
@@ -872,15 +946,8 @@ class SearchCommand(object):
         except Exception as error:
             raise RuntimeError('Failed to parse metadata of length {}: {}'.format(metadata_length, error))
 
-        # if body_length <= 0:
-        #     return metadata, ''
-
-        try:
-            body = ifile.read(body_length)
-        except Exception as error:
-            raise RuntimeError('Failed to read body of length {}: {}'.format(body_length, error))
-
-        return metadata, body
+        # The body is left in ifile and parsed as it is read; callers must consume or drain it before the next chunk
+        return metadata, BoundedReader(ifile, body_length)
 
     _header = re.compile(r'chunked\s+1.0\s*,\s*(\d+)\s*,\s*(\d+)\s*\n')
 
@@ -893,22 +960,10 @@ class SearchCommand(object):
         except StopIteration:
             return
 
-        mv_fieldnames = dict([(name, name[len('__mv_'):]) for name in fieldnames if name.startswith('__mv_')])
-
-        if len(mv_fieldnames) == 0:
-            for values in reader:
-                yield OrderedDict(izip(fieldnames, values))
-            return
+        decode = self._record_decoder(fieldnames)
 
         for values in reader:
-            record = OrderedDict()
-            for fieldname, value in izip(fieldnames, values):
-                if fieldname.startswith('__mv_'):
-                    if len(value) > 0:
-                        record[mv_fieldnames[fieldname]] = self._decode_list(value)
-                elif fieldname not in record:
-                    record[fieldname] = value
-            yield record
+            yield decode(values)
 
     def _records_protocol_v2(self, ifile):
 
@@ -928,28 +983,19 @@ class SearchCommand(object):
             self._record_writer.is_flushed = False
 
             if len(body) > 0:
-                reader = csv.reader(StringIO(body), dialect=CsvDialect)
+                reader = csv.reader(body, dialect=CsvDialect)
 
                 try:
                     fieldnames = reader.next()
                 except StopIteration:
                     return
 
-                mv_fieldnames = dict([(name, name[len('__mv_'):]) for name in fieldnames if name.startswith('__mv_')])
+                decode = self._record_decoder(fieldnames)
 
-                if len(mv_fieldnames) == 0:
-                    for values in reader:
-                        yield OrderedDict(izip(fieldnames, values))
-                else:
-                    for values in reader:
-                        record = OrderedDict()
-                        for fieldname, value in izip(fieldnames, values):
-                            if fieldname.startswith('__mv_'):
-                                if len(value) > 0:
-                                    record[mv_fieldnames[fieldname]] = self._decode_list(value)
-                            elif fieldname not in record:
-                                record[fieldname] = value
-                        yield record
+                for values in reader:
+                    yield decode(values)
+
+                body.drain()
 
             if finished:
                 return